@@ -12,6 +12,7 @@
  #include <time.h>
  #include <signal.h>
  #include <errno.h>
+ #include <stdint.h>
  
  #define PORT 8080
  #define MAX_CLIENTS 64
@@ -33,6 +34,25 @@
      size_t n = strlen(s);
      while (n > 0 && (s[n-1] == '\n' || s[n-1] == '\r')) { s[n-1] = '\0'; n--; }
  }
+
+ /* Read exactly n bytes or fail */
+ static int recv_exact(int sock, char *buf, size_t n) {
+     size_t got = 0;
+     while (got < n) {
+         ssize_t r = recv(sock, buf + got, n - got, 0);
+         if (r <= 0) return -1;
+         got += (size_t)r;
+     }
+     return 0;
+ }
+
+ /* Send a 4-byte big-endian length prefix followed by the payload */
+ static int send_frame(int sock, const char *payload, uint32_t len) {
+     uint32_t be = htonl(len);
+     if (send(sock, &be, sizeof(be), 0) != (ssize_t)sizeof(be)) return -1;
+     if (send(sock, payload, len, 0) != (ssize_t)len) return -1;
+     return 0;
+ }
  
 
  char *insert_message_to_db_pool(const char *message) {
@@ -92,26 +112,29 @@
      mongoc_cursor_t *cursor = mongoc_collection_find_with_opts(coll, query, opts, NULL);
  
      buffer[0] = '\0';
+     size_t off = 0;
      const bson_t *doc;
      bson_iter_t iter;
      while (mongoc_cursor_next(cursor, &doc)) {
          const char *msg = "(null)";
          int64_t millis = 0;
          char timestr[64] = {0};
- 
+
          if (bson_iter_init_find(&iter, doc, "message") && BSON_ITER_HOLDS_UTF8(&iter))
              msg = bson_iter_utf8(&iter, NULL);
          if (bson_iter_init_find(&iter, doc, "timestamp") && BSON_ITER_HOLDS_DATE_TIME(&iter))
              millis = bson_iter_date_time(&iter);
- 
+
          time_t sec = millis / 1000;
          struct tm tm;
          localtime_r(&sec, &tm);
          strftime(timestr, sizeof(timestr), "%Y-%m-%d %H:%M:%S", &tm);
- 
-         char line[1024];
-         snprintf(line, sizeof(line), "[%s] %s\n", timestr, msg);
-         strncat(buffer, line, buffer_size - strlen(buffer) - 1);
+
+         /* Append at the tracked offset; strncat would rescan the whole
+            buffer per message, turning a large dump into O(n^2). */
+         int wrote = snprintf(buffer + off, buffer_size - off, "[%s] %s\n", timestr, msg);
+         if (wrote < 0 || (size_t)wrote >= buffer_size - off) break;
+         off += (size_t)wrote;
      }
  
      mongoc_cursor_destroy(cursor);
@@ -122,9 +145,141 @@
  }
  
 
+ /*
+  * Framed mode: each request is a 4-byte big-endian length prefix plus
+  * payload, each reply likewise.  The connection stays open so the WS
+  * bridge can keep a pool of persistent sockets instead of paying a
+  * connect + shutdown handshake per reader request.  Writer sessions use
+  * the same framing: a "writer" frame (optionally fused with a command,
+  * e.g. "writer\nstart") selects writer mode, after which each frame is
+  * a control word or a message and each reply is one frame.
+  */
+ /* Serve one reader request (history dump) as a frame */
+ static int framed_reader_dump(int sock) {
+     sem_wait(&mutex);
+     reader_count++;
+     if (reader_count == 1) sem_wait(&wrt);
+     sem_post(&mutex);
+
+     char out[BUFFER_SIZE * 8];
+     fetch_messages_from_db_pool(out, sizeof(out));
+
+     sem_wait(&mutex);
+     reader_count--;
+     if (reader_count == 0) sem_post(&wrt);
+     sem_post(&mutex);
+
+     return send_frame(sock, out, (uint32_t)strlen(out));
+ }
+
+ static void handle_framed_client(int sock) {
+     uint32_t be;
+     char payload[BUFFER_SIZE];
+     int is_writer = 0;
+     int is_reader = 0;
+     int has_lock = 0;
+     for (;;) {
+         if (recv_exact(sock, (char *)&be, sizeof(be)) < 0) break;
+         uint32_t len = ntohl(be);
+         if (len == 0) break;
+         if (len >= sizeof(payload)) {
+             /* Drain the oversized payload and reject it with a reply;
+                closing here would leave the bridge waiting out its timeout. */
+             char sink[1024];
+             int failed = 0;
+             while (len > 0) {
+                 uint32_t chunk = len < sizeof(sink) ? len : (uint32_t)sizeof(sink);
+                 if (recv_exact(sock, sink, chunk) < 0) { failed = 1; break; }
+                 len -= chunk;
+             }
+             if (failed) break;
+             const char *err = "ERROR: message too long\n";
+             if (send_frame(sock, err, (uint32_t)strlen(err)) < 0) break;
+             continue;
+         }
+         if (recv_exact(sock, payload, len) < 0) break;
+         payload[len] = '\0';
+         rtrim(payload);
+
+         char *cmd = payload;
+         if (!is_writer && !is_reader) {
+             /* The first frame latches the role; later frames are taken
+                verbatim so a chat message like "reader" or "writer ..."
+                is never mistaken for role selection. */
+             if (strcmp(payload, "reader") == 0) {
+                 is_reader = 1;
+             } else if (strncmp(payload, "writer", 6) == 0) {
+                 is_writer = 1;
+                 cmd += 6;
+                 while (*cmd == ' ' || *cmd == '\n' || *cmd == '\r') cmd++;
+                 if (*cmd == '\0') continue; /* role only, commands follow */
+             } else {
+                 const char *err = "ERROR: unknown framed request\n";
+                 if (send_frame(sock, err, (uint32_t)strlen(err)) < 0) break;
+                 continue;
+             }
+         }
+
+         if (is_reader) {
+             /* Pooled connections repeat the dump request; payload is moot. */
+             if (framed_reader_dump(sock) < 0) break;
+             continue;
+         }
+
+         if (strcmp(cmd, "start") == 0) {
+             if (!has_lock) {
+                 sem_wait(&wrt);
+                 has_lock = 1;
+                 printf("[SERVER] Writer STARTED (sock=%d)\n", sock);
+             }
+             const char *ok = "OK: writer session started\n";
+             if (send_frame(sock, ok, (uint32_t)strlen(ok)) < 0) break;
+         } else if (strcmp(cmd, "stop") == 0) {
+             if (has_lock) {
+                 has_lock = 0;
+                 sem_post(&wrt);
+                 printf("[SERVER] Writer STOPPED (sock=%d)\n", sock);
+                 const char *ok = "OK: writer session stopped\n";
+                 if (send_frame(sock, ok, (uint32_t)strlen(ok)) < 0) break;
+             } else {
+                 const char *err = "ERROR: no active writer session\n";
+                 if (send_frame(sock, err, (uint32_t)strlen(err)) < 0) break;
+             }
+         } else {
+             if (!has_lock) {
+                 const char *err = "ERROR: You must start writing first\n";
+                 if (send_frame(sock, err, (uint32_t)strlen(err)) < 0) break;
+                 continue;
+             }
+             char *res = insert_message_to_db_pool(cmd);
+             int rc = send_frame(sock, res, (uint32_t)strlen(res));
+             free(res);
+             if (rc < 0) break;
+         }
+     }
+
+     if (has_lock) {
+         sem_post(&wrt);
+         printf("[SERVER] Writer lock auto-released (sock=%d)\n", sock);
+     }
+     close(sock);
+ }
+
  void *handle_client(void *arg) {
      int sock = *(int *)arg;
      free(arg);
+
+     /* Framed requests start with a 4-byte length whose first byte is 0;
+        legacy role strings start with ASCII 'r'/'w'. */
+     char first;
+     ssize_t p = recv(sock, &first, 1, MSG_PEEK);
+     if (p <= 0) { close(sock); return NULL; }
+     if (first == '\0') {
+         printf("[SERVER] Framed client connected (sock=%d)\n", sock);
+         handle_framed_client(sock);
+         return NULL;
+     }
+
      char initial[BUFFER_SIZE];
      ssize_t r = recv(sock, initial, sizeof(initial)-1, 0);
      if (r <= 0) { close(sock); return NULL; }
@@ -154,11 +309,11 @@
              if (strcmp(p_after, "start") == 0) {
                  sem_wait(&wrt);
                  has_lock = 1;
-                 send(sock, "OK: writer session started\n", 26, 0);
+                 send(sock, "OK: writer session started\n", 27, 0);
                  printf("[SERVER] Writer STARTED (sock=%d)\n", sock);
              } else if (strcmp(p_after, "stop") == 0) {
  
-                 send(sock, "OK: writer session stopped\n", 26, 0);
+                 send(sock, "OK: writer session stopped\n", 27, 0);
              } else {
                  if (!has_lock) {
                      send(sock, "ERROR: start writing first\n", 27, 0);
@@ -178,13 +333,13 @@
              if (strcmp(buf, "start") == 0) {
                  sem_wait(&wrt);
                  has_lock = 1;
-                 send(sock, "OK: writer session started\n", 26, 0);
+                 send(sock, "OK: writer session started\n", 27, 0);
                  printf("[SERVER] Writer STARTED (sock=%d)\n", sock);
              } else if (strcmp(buf, "stop") == 0) {
                  if (has_lock) {
                      has_lock = 0;
                      sem_post(&wrt);
-                     send(sock, "OK: writer session stopped\n", 26, 0);
+                     send(sock, "OK: writer session stopped\n", 27, 0);
                      printf("[SERVER] Writer STOPPED (sock=%d)\n", sock);
                  } else {
                      send(sock, "ERROR: no active writer session\n", 32, 0);
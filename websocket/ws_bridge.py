@@ -1,175 +1,339 @@
-
-
-import asyncio
-import websockets
-import socket
-import json
-from datetime import datetime
-
-TCP_HOST = "127.0.0.1"
-TCP_PORT = 8080
-WS_HOST = "0.0.0.0"
-WS_PORT = 8765
-
-connected = set()
-writer_tcp_map = {}
-
-def tcp_send_and_recv_sock(s: socket.socket, data: bytes, expect_reply=True, shutdown_write=False, timeout=5):
-    """Send bytes on existing connected socket and read reply (blocking)."""
-    try:
-        s.sendall(data)
-        if shutdown_write:
-            try:
-                s.shutdown(socket.SHUT_WR)
-            except OSError:
-                pass
-        if not expect_reply:
-            return ""
-        s.settimeout(timeout)
-        resp = b""
-        while True:
-            try:
-                chunk = s.recv(4096)
-            except socket.timeout:
-                break
-            if not chunk:
-                break
-            resp += chunk
-        return resp.decode("utf-8", errors="replace")
-    except Exception as e:
-        return f"TCP error: {e}"
-
-def tcp_one_shot(role: str, control: str = None, message: str = None, timeout=5) -> str:
-    """Create a short-lived TCP connection, send role and control/message, read reply, close."""
-    try:
-        with socket.create_connection((TCP_HOST, TCP_PORT), timeout=timeout) as s:
-            s.sendall(role.encode("utf-8"))
-            if role == "writer":
-                if control:
-                    s.sendall(control.encode("utf-8"))
-                elif message:
-                    s.sendall(message.encode("utf-8"))
-            try:
-                s.shutdown(socket.SHUT_WR)
-            except OSError:
-                pass
-            resp = b""
-            while True:
-                chunk = s.recv(4096)
-                if not chunk:
-                    break
-                resp += chunk
-            return resp.decode("utf-8", errors="replace")
-    except Exception as e:
-        return f"TCP error: {e}"
-
-async def broadcast(payload: dict):
-    if not connected:
-        return
-    data = json.dumps({"type": "broadcast", "payload": payload})
-    await asyncio.gather(*(ws.send(data) for ws in connected if ws.open))
-
-async def handle_websocket(ws, path):
-    print("[WS] Client connected")
-    connected.add(ws)
-    try:
-        async for raw in ws:
-            try:
-                data = json.loads(raw)
-            except Exception:
-                await ws.send(json.dumps({"status":"error","message":"invalid json"}))
-                continue
-
-            role = data.get("role")
-            message = data.get("message", "")
-            control = data.get("control", None)
-
-            if role not in ("reader","writer"):
-                await ws.send(json.dumps({"status":"error","message":"role must be 'reader' or 'writer'"}))
-                continue
-            if role == "reader":
-                loop = asyncio.get_running_loop()
-                resp = await loop.run_in_executor(None, tcp_one_shot, "reader", None, None)
-                await ws.send(json.dumps({"status":"ok","role":"reader","data":resp}))
-                continue
-
-            wid = id(ws)
-            if control == "start":
-                if wid in writer_tcp_map:
-                    await ws.send(json.dumps({"status":"error","message":"writer session already active"}))
-                    continue
-                try:
-                    s = socket.create_connection((TCP_HOST, TCP_PORT), timeout=5)
-                except Exception as e:
-                    await ws.send(json.dumps({"status":"error","message":f"TCP connect error: {e}"}))
-                    continue
-
-                resp = await asyncio.get_running_loop().run_in_executor(None, tcp_send_and_recv_sock, s, b"writer", True)
-
-                resp2 = await asyncio.get_running_loop().run_in_executor(None, tcp_send_and_recv_sock, s, b"start", True)
-
-                if resp2.startswith("OK"):
-                    writer_tcp_map[wid] = s
-                    await ws.send(json.dumps({"status":"ok","role":"writer","reply":resp2}))
-                else:
-                    try:
-                        s.close()
-                    except:
-                        pass
-                    await ws.send(json.dumps({"status":"error","message":resp2}))
-                continue
-
-            if control == "stop":
-                s = writer_tcp_map.get(wid)
-                if not s:
-                    await ws.send(json.dumps({"status":"error","message":"no active writer session"}))
-                    continue
-                resp = await asyncio.get_running_loop().run_in_executor(None, tcp_send_and_recv_sock, s, b"stop", True)
-                try:
-                    s.close()
-                except:
-                    pass
-                writer_tcp_map.pop(wid, None)
-                await ws.send(json.dumps({"status":"ok","role":"writer","reply":resp}))
-                continue
-
-            if message:
-                s = writer_tcp_map.get(wid)
-                if not s:
-                    await ws.send(json.dumps({"status":"error","message":"start writer session first"}))
-                    continue
-                resp = await asyncio.get_running_loop().run_in_executor(None, tcp_send_and_recv_sock, s, message.encode("utf-8"), True)
-                if resp.startswith("OK"):
-                    timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                    bobj = {"message": message, "timestamp": timestamp}
-                    await broadcast(bobj)
-                    await ws.send(json.dumps({"status":"ok","role":"writer","reply":resp}))
-                else:
-                    await ws.send(json.dumps({"status":"error","message":resp}))
-                continue
-
-            await ws.send(json.dumps({"status":"error","message":"no control or message provided"}))
-
-    except websockets.exceptions.ConnectionClosed:
-        print("[WS] Client disconnected")
-    finally:
-        wid = id(ws)
-        s = writer_tcp_map.pop(wid, None)
-        if s:
-            try:
-                s.close()
-            except:
-                pass
-        connected.remove(ws)
-
-async def main():
-    print(f"[WS] Serving on ws://{WS_HOST}:{WS_PORT}")
-    async with websockets.serve(handle_websocket, WS_HOST, WS_PORT):
-        await asyncio.Future()
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("WS server stopped")
-
+
+
+import asyncio
+import websockets
+import socket
+import struct
+import zlib
+import orjson
+import os
+import multiprocessing
+from datetime import datetime, timezone
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+TCP_HOST = "127.0.0.1"
+TCP_PORT = 8080
+WS_HOST = "0.0.0.0"
+WS_PORT = 8765
+TCP_POOL_SIZE = 8
+
+BROADCAST_QUEUE_SIZE = 32
+BROADCAST_BATCH = 50
+# Broadcasts at or above this size are zlib-compressed once for all clients.
+BROADCAST_COMPRESS_MIN = 1024
+
+connected = {}
+
+def _err(message: str) -> bytes:
+    """Pre-encode a static error frame so hot paths skip serialization."""
+    return orjson.dumps({"status": "error", "message": message})
+
+ERR_INVALID_JSON = _err("invalid json")
+ERR_BAD_ROLE = _err("role must be 'reader' or 'writer'")
+ERR_ALREADY_ACTIVE = _err("writer session already active")
+ERR_NO_SESSION = _err("no active writer session")
+ERR_START_FIRST = _err("start writer session first")
+ERR_NO_CONTROL = _err("no control or message provided")
+
+TCP_BUF_SIZE = 1 << 20
+
+def _tune_socket(sock):
+    """Disable Nagle and widen the kernel buffers on a backend socket."""
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, "TCP_QUICKACK"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_BUF_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TCP_BUF_SIZE)
+    except OSError:
+        pass
+
+def frame(payload: bytes) -> bytes:
+    """Prefix payload with a 4-byte big-endian length."""
+    return struct.pack(">I", len(payload)) + payload
+
+async def read_frame(reader) -> bytes:
+    """Read one length-prefixed message from an asyncio stream."""
+    hdr = await reader.readexactly(4)
+    (n,) = struct.unpack(">I", hdr)
+    return await reader.readexactly(n)
+
+class TcpPool:
+    """Pool of persistent framed TCP connections to the backend."""
+
+    def __init__(self, host, port, size=TCP_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self._conns = asyncio.Queue()
+        self._opened = 0
+
+    async def acquire(self):
+        if self._conns.empty() and self._opened < self.size:
+            self._opened += 1
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except Exception:
+                self._opened -= 1
+                raise
+            _tune_socket(writer.get_extra_info("socket"))
+            return reader, writer
+        return await self._conns.get()
+
+    def release(self, conn):
+        """Return a healthy connection to the pool."""
+        self._conns.put_nowait(conn)
+
+    def discard(self, conn):
+        """Drop a broken connection so a fresh one can be opened later."""
+        _, writer = conn
+        try:
+            writer.close()
+        except Exception:
+            pass
+        self._opened -= 1
+
+pool = TcpPool(TCP_HOST, TCP_PORT)
+
+async def tcp_request(tcp_reader, tcp_writer, payload: bytes, timeout=5) -> bytes:
+    """Send one framed request on a persistent writer connection and read the framed reply.
+
+    Returns raw bytes; callers decode only when forwarding to a client.
+    On any error the connection is closed: a reply still in flight after a
+    timeout would otherwise be read as the answer to the next request.
+    """
+    try:
+        tcp_writer.write(frame(payload))
+        await tcp_writer.drain()
+        return await asyncio.wait_for(read_frame(tcp_reader), timeout=timeout)
+    except Exception as e:
+        try:
+            tcp_writer.close()
+        except Exception:
+            pass
+        return f"TCP error: {e!r}".encode()
+
+async def tcp_one_shot(role: str, control: str = None, message: str = None, timeout=5) -> bytes:
+    """Send one framed request on a pooled backend connection and read the framed reply.
+
+    Returns raw bytes; callers decode only when forwarding to a client.
+    """
+    payload = role
+    if role == "writer":
+        if control:
+            payload += "\n" + control
+        elif message:
+            payload += "\n" + message
+    try:
+        conn = await pool.acquire()
+    except Exception as e:
+        return f"TCP error: {e!r}".encode()
+    reader, writer = conn
+    try:
+        writer.write(frame(payload.encode("utf-8")))
+        await writer.drain()
+        resp = await asyncio.wait_for(read_frame(reader), timeout=timeout)
+    except Exception as e:
+        pool.discard(conn)
+        return f"TCP error: {e!r}".encode()
+    pool.release(conn)
+    return resp
+
+# Bounds how many relay tasks may be inside ws.send at once, so a burst
+# of backed-up clients drains gradually instead of in one memory spike.
+MAX_CONCURRENT_SENDS = 128
+_broadcast_sem = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+async def _relay(ws, queue):
+    """Drain one client's broadcast queue; a slow client never blocks the rest."""
+    try:
+        while True:
+            msg = await queue.get()
+            async with _broadcast_sem:
+                await ws.send(msg)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+async def broadcast(payload: dict):
+    if not connected:
+        return
+    data = orjson.dumps({"type": "broadcast", "payload": payload})
+    if len(data) >= BROADCAST_COMPRESS_MIN:
+        data = zlib.compress(data, 6)
+    clients = list(connected.items())
+    for i in range(0, len(clients), BROADCAST_BATCH):
+        for ws, queue in clients[i:i + BROADCAST_BATCH]:
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # Client is not draining; drop it rather than buffer unbounded.
+                asyncio.ensure_future(ws.close())
+        # Yield between batches so a large fan-out cannot starve the loop.
+        if i + BROADCAST_BATCH < len(clients):
+            await asyncio.sleep(0)
+
+async def _handle_reader(ws, data):
+    resp = await tcp_one_shot("reader")
+    await ws.send(orjson.dumps({"status":"ok","role":"reader",
+                                "data":resp.decode("utf-8", errors="replace")}))
+
+async def _handle_start(ws, data):
+    if getattr(ws, "_writer_tcp", None) is not None:
+        await ws.send(ERR_ALREADY_ACTIVE)
+        return
+    try:
+        tcp_reader, tcp_writer = await asyncio.open_connection(TCP_HOST, TCP_PORT)
+    except Exception as e:
+        await ws.send(orjson.dumps({"status":"error","message":f"TCP connect error: {e}"}))
+        return
+    _tune_socket(tcp_writer.get_extra_info("socket"))
+
+    resp = await tcp_request(tcp_reader, tcp_writer, b"writer\nstart")
+
+    if resp.startswith(b"OK"):
+        ws._writer_tcp = (tcp_reader, tcp_writer)
+        await ws.send(orjson.dumps({"status":"ok","role":"writer",
+                                    "reply":resp.decode("utf-8", errors="replace")}))
+    else:
+        try:
+            tcp_writer.close()
+        except:
+            pass
+        await ws.send(orjson.dumps({"status":"error",
+                                    "message":resp.decode("utf-8", errors="replace")}))
+
+async def _handle_stop(ws, data):
+    conn = getattr(ws, "_writer_tcp", None)
+    if not conn:
+        await ws.send(ERR_NO_SESSION)
+        return
+    tcp_reader, tcp_writer = conn
+    resp = await tcp_request(tcp_reader, tcp_writer, b"stop")
+    try:
+        tcp_writer.close()
+    except:
+        pass
+    ws._writer_tcp = None
+    await ws.send(orjson.dumps({"status":"ok","role":"writer",
+                                "reply":resp.decode("utf-8", errors="replace")}))
+
+async def _handle_message(ws, message):
+    conn = getattr(ws, "_writer_tcp", None)
+    if not conn:
+        await ws.send(ERR_START_FIRST)
+        return
+    tcp_reader, tcp_writer = conn
+    resp = await tcp_request(tcp_reader, tcp_writer, message.encode("utf-8"))
+    if resp.startswith(b"OK"):
+        timestamp = datetime.now(timezone.utc).isoformat(sep=" ", timespec="seconds")
+        bobj = {"message": message, "timestamp": timestamp}
+        await broadcast(bobj)
+        await ws.send(orjson.dumps({"status":"ok","role":"writer",
+                                    "reply":resp.decode("utf-8", errors="replace")}))
+    else:
+        if tcp_writer.is_closing():
+            # tcp_request tore the connection down; drop the dead session so
+            # the client gets a clean "start writer session first".
+            ws._writer_tcp = None
+        await ws.send(orjson.dumps({"status":"error",
+                                    "message":resp.decode("utf-8", errors="replace")}))
+
+_VALID_ROLES = frozenset(("reader", "writer"))
+
+HANDLERS = {
+    ("reader", None): _handle_reader,
+    ("writer", "start"): _handle_start,
+    ("writer", "stop"): _handle_stop,
+}
+
+async def handle_websocket(ws, path):
+    print("[WS] Client connected")
+    queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+    relay = asyncio.ensure_future(_relay(ws, queue))
+    connected[ws] = queue
+    try:
+        async for raw in ws:
+            try:
+                data = orjson.loads(raw)
+            except Exception:
+                await ws.send(ERR_INVALID_JSON)
+                continue
+
+            role = data.get("role")
+            if role not in _VALID_ROLES:
+                await ws.send(ERR_BAD_ROLE)
+                continue
+
+            handler = HANDLERS.get((role, data.get("control", None)))
+            if handler is not None:
+                await handler(ws, data)
+                continue
+
+            message = data.get("message", "")
+            if message:
+                await _handle_message(ws, message)
+                continue
+
+            await ws.send(ERR_NO_CONTROL)
+
+    except websockets.exceptions.ConnectionClosed:
+        print("[WS] Client disconnected")
+    finally:
+        conn = getattr(ws, "_writer_tcp", None)
+        if conn:
+            try:
+                conn[1].close()
+            except:
+                pass
+        relay.cancel()
+        connected.pop(ws, None)
+
+def _make_ws_socket():
+    """Listening socket with SO_REUSEPORT so the kernel balances workers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((WS_HOST, WS_PORT))
+    sock.listen()
+    return sock
+
+async def main():
+    print(f"[WS] Worker {os.getpid()} serving on ws://{WS_HOST}:{WS_PORT}")
+    async with websockets.serve(
+        handle_websocket,
+        sock=_make_ws_socket(),
+        compression=None,
+        write_limit=2**20,
+    ):
+        await asyncio.Future()
+
+def _run_worker():
+    if uvloop is not None:
+        uvloop.install()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("WS server stopped")
+
+if __name__ == "__main__":
+    # connected/broadcasts are per-process, so multi-worker shards the chat;
+    # keep it opt-in until a cross-worker fan-out (e.g. pub/sub) exists.
+    workers = int(os.environ.get("WS_WORKERS", 1))
+    if workers <= 1 or not hasattr(socket, "SO_REUSEPORT"):
+        _run_worker()
+    else:
+        procs = [multiprocessing.Process(target=_run_worker) for _ in range(workers - 1)]
+        for p in procs:
+            p.start()
+        _run_worker()
+        for p in procs:
+            p.join()
+